@@ -6,7 +6,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import json
-from datetime import datetime, timedelta
+import re
+from datetime import datetime, timedelta, timezone
 import os
 from dotenv import load_dotenv
 import numpy as np
@@ -14,6 +15,13 @@ from matplotlib.colors import ListedColormap
 import matplotlib.dates as mdates
 from PIL import Image
 from io import BytesIO
+import queue
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 
 # Load environment variables (for API keys)
 load_dotenv()
@@ -22,8 +30,12 @@ load_dotenv()
 NASA_API_KEY = os.getenv("NASA_API_KEY", "DEMO_KEY")  # Uses DEMO_KEY if not set
 
 class MarsDataCollector:
-    def __init__(self, api_key=NASA_API_KEY):
+    def __init__(self, api_key=NASA_API_KEY, apod_archive=None):
         self.api_key = api_key
+        # Optional MarsApodArchive; when populated it replaces random APOD sampling
+        self.apod_archive = apod_archive
+        # Reused for paged metadata requests so connections are kept alive
+        self.session = requests.Session()
         
     def get_curiosity_photos(self, sol=1000, camera="FHAZ", page=1, per_page=10):
         """Fetch Mars Rover Curiosity photos based on sol (Mars day)"""
@@ -36,13 +48,37 @@ class MarsDataCollector:
             "api_key": self.api_key
         }
         
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         if response.status_code == 200:
             return response.json()
         else:
             print(f"Error fetching Curiosity photos: {response.status_code}")
             return None
             
+    # The Mars Rover Photos API always pages 25 photos at a time
+    CURIOSITY_PAGE_SIZE = 25
+
+    def iter_curiosity_photos(self, start_sol, end_sol, camera=None):
+        """Yield Curiosity photo records page by page for an inclusive sol range.
+
+        Raises RuntimeError if a page cannot be fetched (e.g. rate limiting),
+        rather than silently skipping the rest of that sol.
+        """
+        for sol in range(start_sol, end_sol + 1):
+            page = 1
+            while True:
+                photos = self.get_curiosity_photos(sol=sol, camera=camera, page=page,
+                                                   per_page=self.CURIOSITY_PAGE_SIZE)
+                if photos is None:
+                    raise RuntimeError(f"Failed to fetch Curiosity photos for sol {sol}, page {page}")
+                if not photos.get("photos"):
+                    break
+                for photo in photos["photos"]:
+                    yield photo
+                if len(photos["photos"]) < self.CURIOSITY_PAGE_SIZE:
+                    break
+                page += 1
+            
     def get_insight_weather(self):
         """Fetch weather data from InSight Mars lander"""
         # Note: InSight stopped returning weather data in 2021, but we'll
@@ -115,6 +151,9 @@ class MarsDataCollector:
         """Get EPIC (Earth Polychromatic Imaging Camera) imagery of Mars"""
         # Note: EPIC is for Earth imagery, not Mars. For demonstration purposes, 
         # we'll use the Mars APOD (Astronomy Picture of the Day) data instead.
+        if self.apod_archive is not None and self.apod_archive.offsets:
+            return self.apod_archive.search(self.apod_archive.MARS_TERMS, limit=10)
+
         url = "https://api.nasa.gov/planetary/apod"
         params = {
             "api_key": self.api_key,
@@ -137,6 +176,41 @@ class MarsDataCollector:
             print(f"Error fetching APOD images: {response.status_code}")
             return None
     
+    def latest_apod_date(self):
+        """Latest date the APOD API will accept"""
+        # APOD rejects dates after "today" in US Eastern time (UTC-5, or UTC-4
+        # in summer); using UTC-5 year-round never runs ahead of the API
+        return (datetime.now(timezone.utc) - timedelta(hours=5)).date()
+
+    def iter_apod_range(self, start_date, end_date, chunk_days=1825, timeout=120):
+        """Yield APOD entries between two dates, requesting them in date-range chunks.
+
+        Raises RuntimeError if a chunk cannot be fetched, so a partial range
+        is never mistaken for a complete one.
+        """
+        url = "https://api.nasa.gov/planetary/apod"
+        end_date = min(end_date, self.latest_apod_date())
+        chunk_start = start_date
+
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+            params = {
+                "api_key": self.api_key,
+                "start_date": chunk_start.isoformat(),
+                "end_date": chunk_end.isoformat(),
+                "thumbs": True
+            }
+
+            response = self.session.get(url, params=params, timeout=timeout)
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"Failed to fetch APOD entries {chunk_start} to {chunk_end}: {response.status_code}"
+                )
+
+            for entry in sorted(response.json(), key=lambda entry: entry["date"]):
+                yield entry
+            chunk_start = chunk_end + timedelta(days=1)
+
     def get_mars_assets(self):
         """Get Mars imagery from NASA Earth Observations assets"""
         # This is simulated for demonstration purposes
@@ -154,6 +228,117 @@ class MarsDataCollector:
         }
 
 
+class MarsApodArchive:
+    """Local copy of the APOD archive with an inverted index of Mars keywords.
+
+    Entries are appended to a JSON Lines file as date-range chunks stream in,
+    and the index maps each keyword to the dates that mention it plus the byte
+    offset of every stored entry, so lookups only read the matching lines.
+    """
+
+    FIRST_APOD_DATE = "1995-06-16"
+    MARS_TERMS = ["mars", "martian"]
+    ROVER_NAMES = ["Sojourner", "Spirit", "Opportunity", "Curiosity", "Perseverance", "Zhurong"]
+
+    def __init__(self, collector, data_dir="apod_archive"):
+        self.collector = collector
+        self.archive_path = os.path.join(data_dir, "apod.jsonl")
+        self.index_path = os.path.join(data_dir, "apod_index.json")
+        self.data_dir = data_dir
+
+        feature_names = [asset["name"] for asset in collector.get_mars_assets()["assets"]]
+        self.keywords = [term.lower() for term in self.MARS_TERMS + self.ROVER_NAMES + feature_names]
+        self._keyword_pattern = re.compile(
+            r"\b(" + "|".join(re.escape(keyword) for keyword in self.keywords) + r")\b"
+        )
+        self._load_index()
+
+    def _load_index(self):
+        """Load the keyword index from disk, or start an empty one"""
+        if os.path.exists(self.index_path) and os.path.exists(self.archive_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.offsets = index["offsets"]
+            self.keyword_dates = {keyword: set(dates) for keyword, dates in index["keywords"].items()}
+        else:
+            # The index and the data file are only usable together; drop a
+            # leftover half so the next sync rebuilds both from scratch
+            for path in (self.index_path, self.archive_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.offsets = {}
+            self.keyword_dates = {}
+
+    def _save_index(self):
+        """Write the keyword index to disk"""
+        index = {
+            "offsets": self.offsets,
+            "keywords": {keyword: sorted(dates) for keyword, dates in self.keyword_dates.items()}
+        }
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _index_entry(self, entry):
+        """Add an entry's Mars keywords to the inverted index"""
+        text = f"{entry.get('title', '')} {entry.get('explanation', '')}".lower()
+        matches = set(self._keyword_pattern.findall(text))
+
+        # Rover and feature names like "Spirit" or "Curiosity" are common words,
+        # so only count them when the entry is about Mars in the first place
+        if not matches.intersection(self.MARS_TERMS):
+            return
+
+        for keyword in matches:
+            self.keyword_dates.setdefault(keyword, set()).add(entry["date"])
+
+    @property
+    def latest_date(self):
+        """Most recent APOD date stored locally, or None if the archive is empty"""
+        return max(self.offsets) if self.offsets else None
+
+    def sync(self, end_date=None, chunk_days=1825):
+        """Stream any APOD entries newer than the local archive and index them"""
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        if self.latest_date:
+            start = datetime.strptime(self.latest_date, "%Y-%m-%d").date() + timedelta(days=1)
+        else:
+            start = datetime.strptime(self.FIRST_APOD_DATE, "%Y-%m-%d").date()
+        end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else self.collector.latest_apod_date()
+
+        added = 0
+        try:
+            with open(self.archive_path, "ab") as f:
+                for entry in self.collector.iter_apod_range(start, end, chunk_days=chunk_days):
+                    if entry["date"] in self.offsets:
+                        continue
+                    self.offsets[entry["date"]] = f.tell()
+                    f.write(json.dumps(entry).encode("utf-8") + b"\n")
+                    self._index_entry(entry)
+                    added += 1
+        finally:
+            # Keep whatever was fetched so an interrupted sync can resume
+            self._save_index()
+
+        print(f"Stored {added} new APOD entries (archive now holds {len(self.offsets)}).")
+        return added
+
+    def search(self, keywords=("mars",), limit=None):
+        """Return stored APOD entries matching any of the keywords, newest first"""
+        dates = set()
+        for keyword in keywords:
+            dates.update(self.keyword_dates.get(keyword.lower(), ()))
+
+        results = []
+        with open(self.archive_path, "rb") as f:
+            for date in sorted(dates, reverse=True)[:limit]:
+                f.seek(self.offsets[date])
+                results.append(json.loads(f.readline()))
+        return results
+
+
 class MarsDataAnalyzer:
     def __init__(self, collector):
         self.collector = collector
@@ -262,7 +447,8 @@ class MarsDataAnalyzer:
                             "camera": photo["camera"]["name"],
                             "earth_date": photo["earth_date"],
                             "rover": photo["rover"]["name"],
-                            "rover_status": photo["rover"]["status"]
+                            "rover_status": photo["rover"]["status"],
+                            "img_src": photo["img_src"]
                         }
                         all_photos.append(photo_info)
         
@@ -273,6 +459,332 @@ class MarsDataAnalyzer:
         return pd.DataFrame(all_photos)
 
 
+def _thumbnail_and_hash(image_path, thumb_dir, thumb_size, hash_size):
+    """Write a thumbnail for a downloaded image and return its difference hash (dHash)"""
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+
+        # dHash: compare horizontally adjacent pixels of a tiny grayscale copy
+        gray = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = gray.tobytes()
+        phash = 0
+        for row in range(hash_size):
+            for col in range(hash_size):
+                left = pixels[row * (hash_size + 1) + col]
+                right = pixels[row * (hash_size + 1) + col + 1]
+                phash = (phash << 1) | (left > right)
+
+        img.thumbnail(thumb_size)
+        thumb_name = os.path.splitext(os.path.basename(image_path))[0] + ".jpg"
+        thumb_path = os.path.join(thumb_dir, thumb_name)
+        img.save(thumb_path, "JPEG")
+
+    return thumb_path, phash
+
+
+class _HashBandIndex:
+    """Lookup of perceptual hashes within a Hamming distance of each other.
+
+    Each hash is split into max_distance + 1 bands; any two hashes within
+    max_distance bits must share at least one band exactly, so only hashes
+    in a matching band bucket need a full comparison.
+    """
+
+    def __init__(self, hash_bits, max_distance):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = -(-hash_bits // self.bands)
+        self.band_mask = (1 << self.band_bits) - 1
+        self.buckets = [{} for _ in range(self.bands)]
+
+    def _band_keys(self, phash):
+        return [(phash >> (band * self.band_bits)) & self.band_mask for band in range(self.bands)]
+
+    def find(self, phash):
+        """Return the lowest id stored within max_distance of phash, or None"""
+        matches = [
+            other_id
+            for band, key in enumerate(self._band_keys(phash))
+            for other_hash, other_id in self.buckets[band].get(key, ())
+            if bin(phash ^ other_hash).count("1") <= self.max_distance
+        ]
+        return min(matches) if matches else None
+
+    def add(self, phash, photo_id):
+        for band, key in enumerate(self._band_keys(phash)):
+            self.buckets[band].setdefault(key, []).append((phash, photo_id))
+
+
+class MarsImagePipeline:
+    """Download rover photos, build thumbnails and perceptual hashes, and flag near-duplicates.
+
+    Stages are connected by bounded queues so that a slow stage blocks the
+    ones feeding it, keeping memory flat regardless of how many photos flow
+    through: photo records -> download threads -> process pool -> dedup.
+    """
+
+    _STOP = object()
+
+    def __init__(self, collector, output_dir="mars_images", download_workers=8,
+                 hash_workers=None, queue_size=64, thumb_size=(128, 128),
+                 hash_size=8, max_distance=4, chunk_size=64 * 1024, timeout=30):
+        self.collector = collector
+        self.image_dir = os.path.join(output_dir, "full")
+        self.thumb_dir = os.path.join(output_dir, "thumbnails")
+        self.download_workers = download_workers
+        self.hash_workers = hash_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.thumb_size = thumb_size
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        # One pooled session shared by all download threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=download_workers, pool_maxsize=download_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def run(self, start_sol, end_sol, camera=None):
+        """Process every Curiosity photo in a sol range and return a DataFrame of results"""
+        photos = self.collector.iter_curiosity_photos(start_sol, end_sol, camera=camera)
+        records = self.mark_duplicates(list(self.process_photos(photos)))
+
+        if not records:
+            print("No rover images processed.")
+            return None
+
+        df = pd.DataFrame(records)
+        df["duplicate_of"] = df["duplicate_of"].astype("Int64")
+        return df
+
+    def mark_duplicates(self, records):
+        """Set duplicate_of in id order so each near-duplicate group points at its lowest id"""
+        records = sorted(records, key=lambda record: record["id"])
+        index = _HashBandIndex(self.hash_size * self.hash_size, self.max_distance)
+
+        for record in records:
+            phash = int(record["phash"], 16)
+            record["duplicate_of"] = index.find(phash)
+            if record["duplicate_of"] is None:
+                index.add(phash, record["id"])
+
+        return records
+
+    def process_photos(self, photos):
+        """Yield one record per successfully processed photo from an iterable of photo records.
+
+        Records are yielded in the order hashing finishes; pass them through
+        mark_duplicates (as run does) to flag near-duplicates.
+        Raises RuntimeError if a pipeline stage fails.
+        """
+        os.makedirs(self.image_dir, exist_ok=True)
+        os.makedirs(self.thumb_dir, exist_ok=True)
+
+        stop = threading.Event()
+        errors = []
+        download_queue = queue.Queue(maxsize=self.queue_size)
+        hash_queue = queue.Queue(maxsize=self.queue_size)
+        result_queue = queue.Queue(maxsize=self.queue_size)
+
+        threads = [threading.Thread(target=self._feed, args=(photos, download_queue, stop, errors), daemon=True)]
+        threads += [
+            threading.Thread(target=self._download_worker, args=(download_queue, hash_queue, stop, errors), daemon=True)
+            for _ in range(self.download_workers)
+        ]
+        threads.append(threading.Thread(target=self._hash_dispatcher,
+                                        args=(hash_queue, result_queue, stop, errors), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        hash_bits = self.hash_size * self.hash_size
+
+        try:
+            while True:
+                item = self._get(result_queue, stop, threads)
+                if item is self._STOP:
+                    break
+                photo, image_path, thumb_path, phash = item
+                yield {
+                    "id": photo["id"],
+                    "sol": photo.get("sol"),
+                    "camera": photo.get("camera", {}).get("name"),
+                    "earth_date": photo.get("earth_date"),
+                    "img_src": photo["img_src"],
+                    "image_path": image_path,
+                    "thumbnail_path": thumb_path,
+                    "phash": f"{phash:0{hash_bits // 4}x}"
+                }
+
+            if errors:
+                raise RuntimeError(f"Image pipeline failed: {errors[0]}") from errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _put(self, q, item, stop):
+        """Put an item on a bounded queue, giving up once the pipeline is stopping"""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q, stop, threads=None):
+        """Get an item from a queue, returning _STOP once the pipeline is stopping.
+
+        If threads is given and they have all exited without posting anything
+        further, raise instead of waiting forever.
+        """
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                if threads is not None and not any(thread.is_alive() for thread in threads):
+                    try:
+                        return q.get_nowait()
+                    except queue.Empty:
+                        raise RuntimeError("Image pipeline stopped without finishing")
+        return self._STOP
+
+    def _feed(self, photos, download_queue, stop, errors):
+        """Push photo records into the download queue, then one stop marker per worker"""
+        try:
+            for photo in photos:
+                if "id" not in photo or not photo.get("img_src"):
+                    print(f"Skipping photo record without id or img_src: {photo}")
+                    continue
+                if not self._put(download_queue, photo, stop):
+                    return
+        except Exception as e:
+            print(f"Error listing rover photos: {e}")
+            errors.append(e)
+        finally:
+            for _ in range(self.download_workers):
+                self._put(download_queue, self._STOP, stop)
+
+    def _download_worker(self, download_queue, hash_queue, stop, errors):
+        """Stream photo bodies to disk and hand the saved paths to the hashing stage"""
+        try:
+            while True:
+                photo = self._get(download_queue, stop)
+                if photo is self._STOP:
+                    return
+
+                try:
+                    image_path = self._download(photo)
+                except Exception as e:
+                    print(f"Error downloading photo {photo.get('id')}: {e}")
+                    continue
+
+                if image_path and not self._put(hash_queue, (photo, image_path), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._put(hash_queue, self._STOP, stop)
+
+    def _download(self, photo):
+        """Stream one photo body to disk, returning its path or None if the download failed"""
+        ext = os.path.splitext(urlparse(photo["img_src"]).path)[1] or ".jpg"
+        image_path = os.path.join(self.image_dir, f"{photo['id']}{ext}")
+        if os.path.exists(image_path):
+            return image_path
+
+        partial_path = image_path + ".part"
+        try:
+            with self.session.get(photo["img_src"], stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print(f"Error downloading photo {photo['id']}: {response.status_code}")
+                    return None
+                with open(partial_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+            os.replace(partial_path, image_path)
+        except (requests.RequestException, OSError) as e:
+            print(f"Error downloading photo {photo['id']}: {e}")
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            return None
+
+        return image_path
+
+    def _new_pool(self):
+        """Create the hashing process pool without forking this multi-threaded process"""
+        # The pool is (re)started while download threads hold locks, so plain
+        # fork could deadlock a child; forkserver/spawn start from a clean process
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=self.hash_workers, mp_context=context)
+
+    def _hash_dispatcher(self, hash_queue, result_queue, stop, errors):
+        """Feed downloaded images to the process pool, keeping a bounded number in flight"""
+        remaining_workers = self.download_workers
+        in_flight = {}
+
+        def drain(return_when):
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                photo, image_path = in_flight.pop(future)
+                try:
+                    thumb_path, phash = future.result()
+                except BrokenProcessPool as e:
+                    print(f"Error hashing photo {photo['id']}: {e}")
+                    continue
+                except Exception as e:
+                    # Most likely a truncated or non-image body; drop it so the
+                    # next run downloads it again instead of reusing it
+                    print(f"Error hashing photo {photo['id']}: {e}")
+                    if os.path.exists(image_path):
+                        os.remove(image_path)
+                    continue
+                self._put(result_queue, (photo, image_path, thumb_path, phash), stop)
+
+        def submit(item):
+            return executor.submit(_thumbnail_and_hash, item[1], self.thumb_dir,
+                                   self.thumb_size, self.hash_size)
+
+        executor = self._new_pool()
+        try:
+            while remaining_workers:
+                item = self._get(hash_queue, stop)
+                if item is self._STOP:
+                    if stop.is_set():
+                        break
+                    remaining_workers -= 1
+                    continue
+
+                try:
+                    future = submit(item)
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory); the photos it had in
+                    # flight are reported as failed and the pool is replaced
+                    print("Hashing process pool broke; restarting it")
+                    drain(ALL_COMPLETED)
+                    executor.shutdown(wait=True)
+                    executor = self._new_pool()
+                    future = submit(item)
+
+                in_flight[future] = item
+                if len(in_flight) >= self.queue_size:
+                    drain(FIRST_COMPLETED)
+
+            if in_flight and not stop.is_set():
+                drain(ALL_COMPLETED)
+        except Exception as e:
+            print(f"Error hashing rover photos: {e}")
+            errors.append(e)
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self._put(result_queue, self._STOP, stop)
+
+
 class MarsDataVisualizer:
     def __init__(self, analyzer):
         self.analyzer = analyzer